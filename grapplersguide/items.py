@@ -68,6 +68,7 @@ class Video:
     download_url: str
     lesson: Lesson
     download_path: Optional[pathlib.Path] = None
+    duration: Optional[float] = None
 
     def __lt__(self, other):
         if self.lesson is other.lesson or self.lesson == other.lesson:
@@ -0,0 +1,98 @@
+# Minimal MP4 (ISO base media file) container checks.
+#
+# Only box headers are read, seeking over payloads, so validating a large
+# video never loads it into memory.
+#
+# See: https://developer.apple.com/documentation/quicktime-file-format
+import os
+import pathlib
+import struct
+from typing import BinaryIO, Iterator, Tuple, Union
+
+_REQUIRED_BOXES = frozenset({b"ftyp", b"moov", b"mdat"})
+
+
+class InvalidMP4Error(ValueError):
+    pass
+
+
+def _iter_boxes(
+    f: BinaryIO,
+    start: int,
+    end: int,
+) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield ``(type, payload_offset, box_end)`` for boxes in a byte range."""
+    offset = start
+    while offset < end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            raise InvalidMP4Error(f"Truncated box header at offset {offset}")
+        size, box_type = struct.unpack(">I4s", header)
+        payload_offset = offset + 8
+        if size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                raise InvalidMP4Error(f"Truncated box size at offset {offset}")
+            (size,) = struct.unpack(">Q", large_size)
+            payload_offset += 8
+        elif size == 0:
+            size = end - offset
+        if size < payload_offset - offset:
+            raise InvalidMP4Error(
+                f"Invalid {box_type!r} box size {size} at offset {offset}"
+            )
+        box_end = offset + size
+        if box_end > end:
+            raise InvalidMP4Error(
+                f"{box_type!r} box at offset {offset} ends at {box_end},"
+                f" past the end of its container at {end}"
+            )
+        yield box_type, payload_offset, box_end
+        offset = box_end
+
+
+def _read_mvhd_duration(f: BinaryIO, offset: int, end: int) -> float:
+    f.seek(offset)
+    version_and_flags = f.read(4)
+    if len(version_and_flags) < 4:
+        raise InvalidMP4Error("Truncated mvhd box")
+    fields_format = ">QQIQ" if version_and_flags[0] == 1 else ">IIII"
+    fields_size = struct.calcsize(fields_format)
+    fields = f.read(fields_size)
+    if len(fields) < fields_size or offset + 4 + fields_size > end:
+        raise InvalidMP4Error("Truncated mvhd box")
+    _, _, timescale, duration = struct.unpack(fields_format, fields)
+    if not timescale:
+        raise InvalidMP4Error("mvhd box has a zero timescale")
+    return duration / timescale
+
+
+def validate(path: Union[str, os.PathLike]) -> float:
+    """Check the box structure of an MP4 file and return its duration.
+
+    Raises InvalidMP4Error when ``ftyp``, ``moov``, ``mdat`` or ``mvhd`` are
+    missing, or when any box length runs past the end of its container.
+    """
+    path = pathlib.Path(path)
+    file_size = path.stat().st_size
+    with path.open("rb") as f:
+        seen = set()
+        duration = None
+        for box_type, payload_offset, box_end in _iter_boxes(f, 0, file_size):
+            seen.add(box_type)
+            if box_type != b"moov":
+                continue
+            for child_type, child_offset, child_end in _iter_boxes(
+                f, payload_offset, box_end
+            ):
+                if child_type == b"mvhd":
+                    duration = _read_mvhd_duration(f, child_offset, child_end)
+
+    missing = _REQUIRED_BOXES - seen
+    if missing:
+        names = ", ".join(sorted(box.decode() for box in missing))
+        raise InvalidMP4Error(f"Missing top-level boxes: {names}")
+    if duration is None:
+        raise InvalidMP4Error("Missing mvhd box")
+    return duration
@@ -5,21 +5,45 @@
 #
 # useful for handling different item types with a single interface
 # from itemadapter import ItemAdapter
+import concurrent.futures
+import contextlib
 import dataclasses as dc
+import enum
 import functools as fn
+import hashlib
+import heapq
 import itertools as it
 import logging
+import multiprocessing
 import operator as op
+import os
 import os.path
 import pathlib
-from typing import List, NamedTuple, Optional, Union
+import re
+import shutil
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import itemadapter
+import scrapy.crawler
+import scrapy.exceptions
 import scrapy.http
 import scrapy.pipelines.files
 import scrapy.settings
+import scrapy.signals
+import scrapy.utils.defer
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
-from . import items, spiders
+from . import items, mp4, spiders, utils
 
 
 def _get_output_dir(settings: scrapy.settings.Settings) -> pathlib.Path:
@@ -30,17 +54,154 @@ def _get_flat_output(settings: scrapy.settings.Settings):
     return settings.getbool("FLAT_OUTPUT", default=False)
 
 
+def _get_flat_output_links(settings: scrapy.settings.Settings):
+    return settings.getbool("FLAT_OUTPUT_LINKS", default=True)
+
+
+_SIZE_REGEX = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$", re.IGNORECASE
+)
+_SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def _parse_size(size: Union[str, int, float, None]) -> Optional[int]:
+    """Parse a size like ``123456``, ``"117.7MB"`` or ``"1.2 GB"`` to bytes."""
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = _SIZE_REGEX.match(size)
+    if match is None:
+        return None
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+_DEFAULT_MIN_FREE_SPACE = 1 << 30
+
+
+def _get_min_free_space(settings: scrapy.settings.Settings) -> int:
+    min_free_space = settings.get("MIN_FREE_SPACE", _DEFAULT_MIN_FREE_SPACE)
+    parsed = _parse_size(min_free_space)
+    if parsed is None:
+        raise ValueError(f"Invalid MIN_FREE_SPACE: {min_free_space!r}")
+    return parsed
+
+
+class DownloadOrder(str, enum.Enum):
+    COURSE = "course"
+    SMALLEST = "smallest"
+
+
+def _get_download_order(settings: scrapy.settings.Settings) -> DownloadOrder:
+    return DownloadOrder(settings.get("DOWNLOAD_ORDER", DownloadOrder.COURSE))
+
+
+def _get_max_active_downloads(
+    settings: scrapy.settings.Settings,
+) -> Optional[int]:
+    return settings.getint("MAX_ACTIVE_DOWNLOADS", default=0) or None
+
+
+def _get_validation_processes(
+    settings: scrapy.settings.Settings,
+) -> Optional[int]:
+    return settings.getint("VALIDATION_PROCESSES", default=0) or None
+
+
+def _readable_path(video: items.Video) -> str:
+    lesson = video.lesson
+    section = lesson.section
+    course = section.course
+    expert = course.expert
+    relative_path = os.path.join(
+        expert.name,
+        course.title,
+        f"{section.position:02d} - {section.title}",
+        " ".join(
+            [
+                f"{lesson.position:02d}",
+                "-",
+                lesson.title,
+                f"({video.public_name}).{video.extension}",
+            ]
+        ),
+    )
+    return relative_path
+
+
+class AtomicFSFilesStore(scrapy.pipelines.files.FSFilesStore):
+    def persist_file(self, path, buf, info, meta=None, headers=None):
+        absolute_path = self._get_filesystem_path(path)
+        self._mkdir(absolute_path.parent, info)
+        with utils.atomic_open(absolute_path) as f:
+            f.write(buf.getvalue())
+
+
+class _PendingDownload(NamedTuple):
+    key: Tuple[Any, int]
+    size: int
+    ready: defer.Deferred
+
+    @property
+    def reservation(self) -> int:
+        return self.key[1]
+
+
+class _InsufficientSpace(Exception):
+    """A video turned out larger than its reservation allows for."""
+
+    def __init__(self, size: int):
+        super().__init__(f"Not enough free space for {size} bytes")
+        self.size = size
+
+
+_RESERVATION_META = "video_reservation"
+
+
 class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
+    STORE_SCHEMES = {
+        **scrapy.pipelines.files.FilesPipeline.STORE_SCHEMES,
+        "": AtomicFSFilesStore,
+        "file": AtomicFSFilesStore,
+    }
+
+    _active_downloads: int
+    _download_order: DownloadOrder
     _flat_output: bool
+    _flat_output_links: bool
+    _max_active_downloads: Optional[int]
+    _min_free_space: int
+    _item_reservations: Dict[int, int]
     _output_dir: pathlib.Path
+    _oversized: Dict[int, int]
+    _pending_downloads: List[_PendingDownload]
+    _reservations: Dict[int, int]
+    _reserved_space: int
+    _sequence: "it.count[int]"
 
     def __init__(
         self,
         output_dir: Union[str, pathlib.Path],
         flat_output: bool,
+        flat_output_links: bool = True,
+        min_free_space: int = _DEFAULT_MIN_FREE_SPACE,
+        download_order: DownloadOrder = DownloadOrder.COURSE,
+        max_active_downloads: Optional[int] = None,
     ):
         self._output_dir = pathlib.Path(output_dir).resolve()
-        self._flat_output = flat_output  # TODO(dfrank): Support flat output
+        self._flat_output = flat_output
+        self._flat_output_links = flat_output_links
+        self._min_free_space = min_free_space
+        self._download_order = download_order
+        self._max_active_downloads = max_active_downloads
+        self._active_downloads = 0
+        self._item_reservations = {}
+        self._oversized = {}
+        self._pending_downloads = []
+        self._reservations = {}
+        self._reserved_space = 0
+        self._sequence = it.count()
         super().__init__(store_uri=self._output_dir.as_uri())
         # TODO(dfrank): Fix allowing redirects from settings
         self.allow_redirects = True
@@ -59,6 +220,11 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
             spider.name,
             self._output_dir,
         )
+        self.logger.info(
+            "Keeping at least %d bytes free, downloading in %s order",
+            self._min_free_space,
+            self._download_order.value,
+        )
 
     def process_item(
         self,
@@ -72,7 +238,194 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
             spider.name,
             item,
         )
-        return super().process_item(item, spider)
+        if self._is_downloaded(item):
+            self.logger.debug("Reserving no space for downloaded %s", item)
+            size = 0
+        else:
+            size = _parse_size(item.size)
+            if size is None:
+                self.logger.warning(
+                    "Unknown size %r, reserving no space for %s",
+                    item.size,
+                    item,
+                )
+                size = 0
+        return self._hold_download(item, spider, size)
+
+    def _is_downloaded(self, item: items.Video) -> bool:
+        """Whether FilesPipeline will skip the video as already up to date."""
+        path = self._output_dir / self.file_path(None, item=item)
+        try:
+            last_modified = path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        age_days = (time.time() - last_modified) / 60 / 60 / 24
+        return age_days <= self.expires
+
+    def _hold_download(
+        self,
+        item: items.Video,
+        spider: spiders.ExpertCoursesSpider,
+        size: int,
+    ) -> defer.Deferred:
+        """Queue a download until ``size`` bytes can be reserved for it."""
+        pending = _PendingDownload(
+            key=(self._download_order_key(item, size), next(self._sequence)),
+            size=size,
+            ready=defer.Deferred(),
+        )
+        pending.ready.addCallback(self._start_download, item, spider, pending)
+        heapq.heappush(self._pending_downloads, pending)
+        self._schedule_downloads()
+        return pending.ready
+
+    def _start_download(
+        self,
+        _,
+        item: items.Video,
+        spider: spiders.ExpertCoursesSpider,
+        pending: _PendingDownload,
+    ) -> defer.Deferred:
+        self._item_reservations[id(item)] = pending.reservation
+        downloaded = scrapy.utils.defer.deferred_from_coro(
+            super().process_item(item, spider)
+        )
+        downloaded.addBoth(self._release_download, item, pending)
+        downloaded.addErrback(self._requeue_download, item, spider)
+        return downloaded
+
+    def _requeue_download(
+        self,
+        failure: Failure,
+        item: items.Video,
+        spider: spiders.ExpertCoursesSpider,
+    ) -> defer.Deferred:
+        failure.trap(_InsufficientSpace)
+        self.logger.info(
+            "Holding %s until %d bytes are free",
+            item,
+            failure.value.size,
+        )
+        return self._hold_download(item, spider, failure.value.size)
+
+    def _download_order_key(self, item: items.Video, size: int):
+        if self._download_order is DownloadOrder.SMALLEST:
+            return size
+        return item
+
+    def _free_space(self) -> int:
+        return shutil.disk_usage(self._output_dir).free
+
+    def _available_space(self) -> int:
+        return self._free_space() - self._reserved_space - self._min_free_space
+
+    def _engine_closing(self) -> bool:
+        engine = self.crawler.engine
+        if engine is None:
+            return False
+        return not engine.running or bool(getattr(engine.slot, "closing", 0))
+
+    def _schedule_downloads(self):
+        """Start held downloads, in order, while there is room for them.
+
+        A download that does not fit while nothing else is downloading never
+        will during this run, so it is dropped for a later run to pick up.
+        """
+        if self._engine_closing():
+            self._drop_pending_downloads(
+                "Spider closed before there was space to download"
+            )
+            return
+
+        while self._pending_downloads and (
+            self._max_active_downloads is None
+            or self._active_downloads < self._max_active_downloads
+        ):
+            pending = self._pending_downloads[0]
+            available_space = self._available_space()
+            if pending.size and pending.size > available_space:
+                if self._active_downloads:
+                    break
+                heapq.heappop(self._pending_downloads)
+                self.logger.error(
+                    "Not enough free space to download %d bytes: %d bytes"
+                    " free with a watermark of %d bytes",
+                    pending.size,
+                    self._free_space(),
+                    self._min_free_space,
+                )
+                pending.ready.errback(
+                    scrapy.exceptions.DropItem(
+                        f"Not enough free space for {pending.size} bytes"
+                    )
+                )
+                continue
+            heapq.heappop(self._pending_downloads)
+            self._active_downloads += 1
+            self._reservations[pending.reservation] = pending.size
+            self._reserved_space += pending.size
+            self.logger.debug(
+                "Reserved %d bytes, %d bytes reserved in total",
+                pending.size,
+                self._reserved_space,
+            )
+            pending.ready.callback(None)
+
+    def _drop_pending_downloads(self, reason: str):
+        if self._pending_downloads:
+            self.logger.info(
+                "Dropping %d held downloads: %s",
+                len(self._pending_downloads),
+                reason,
+            )
+        while self._pending_downloads:
+            pending = heapq.heappop(self._pending_downloads)
+            pending.ready.errback(scrapy.exceptions.DropItem(reason))
+
+    def _release_download(
+        self,
+        result,
+        item: items.Video,
+        pending: _PendingDownload,
+    ):
+        self._active_downloads -= 1
+        self._item_reservations.pop(id(item), None)
+        self._oversized.pop(pending.reservation, None)
+        self._reserved_space -= self._reservations.pop(pending.reservation)
+        self._schedule_downloads()
+        return result
+
+    def _headers_received(
+        self,
+        headers,
+        body_length: Union[int, str],
+        request: scrapy.Request,
+        spider: spiders.ExpertCoursesSpider,
+    ):
+        """Stop a transfer whose Content-Length outgrows its reservation."""
+        reservation = request.meta.get(_RESERVATION_META)
+        if reservation not in self._reservations:
+            return
+        # Twisted reports chunked responses with a str UNKNOWN_LENGTH
+        if not isinstance(body_length, int) or body_length < 0:
+            return
+        extra = body_length - self._reservations[reservation]
+        if extra <= 0:
+            return
+        if extra > self._available_space():
+            # Kept here since redirects copy request.meta
+            self._oversized[reservation] = body_length
+            raise scrapy.exceptions.StopDownload(fail=True)
+        self._reservations[reservation] += extra
+        self._reserved_space += extra
+
+    def media_failed(self, failure, request, info):
+        reservation = request.meta.get(_RESERVATION_META)
+        if failure.check(scrapy.exceptions.StopDownload) and (
+            reservation in self._oversized
+        ):
+            raise _InsufficientSpace(self._oversized.pop(reservation))
+        return super().media_failed(failure, request, info)
 
     def file_path(
         self,
@@ -85,27 +438,25 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
         if not isinstance(item, items.Video):
             raise scrapy.exceptions.DropItem(f"item is not a video: {item}")
 
-        video = item
-        lesson = video.lesson
-        section = lesson.section
-        course = section.course
-        expert = course.expert
-        relative_path = os.path.join(
-            expert.name,
-            course.title,
-            f"{section.position:02d} - {section.title}",
-            " ".join(
-                [
-                    f"{lesson.position:02d}",
-                    "-",
-                    lesson.title,
-                    f"({video.public_name}).{video.extension}",
-                ]
-            ),
-        )
+        if self._flat_output:
+            relative_path = self._sharded_path(item)
+        else:
+            relative_path = _readable_path(item)
         self.logger.debug("Built relative file path: %s", relative_path)
         return relative_path
 
+    def _sharded_path(self, video: items.Video) -> str:
+        """Fan files out over ``ab/cd/`` directories keyed by video id."""
+        digest = hashlib.sha1(
+            video.video_file_id.encode(),
+            usedforsecurity=False,
+        ).hexdigest()
+        return os.path.join(
+            digest[:2],
+            digest[2:4],
+            f"{digest}.{video.extension}",
+        )
+
     def get_media_requests(self, item: items.Video, info):
         self.logger.debug(
             "Getting media requests for item=%s info=%s",
@@ -113,7 +464,10 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
             info,
         )
         adapter = itemadapter.ItemAdapter(item)
-        yield scrapy.Request(adapter["download_url"])
+        yield scrapy.Request(
+            adapter["download_url"],
+            meta={_RESERVATION_META: self._item_reservations.get(id(item))},
+        )
 
     def item_completed(self, results, item: items.Video, info):
         if not results:
@@ -121,6 +475,14 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
                 f"Nothing downloaded for item: {item}",
             )
         for ok, result in results:
+            if isinstance(result, Failure) and result.check(_InsufficientSpace):
+                # Forget the cached failure so the requeued download runs
+                for fingerprint, cached in list(info.downloaded.items()):
+                    if cached is result or getattr(cached, "value", None) is (
+                        result.value
+                    ):
+                        del info.downloaded[fingerprint]
+                result.raiseException()
             if isinstance(result, BaseException):
                 self.logger.critical(
                     "Unhandled error downloading item: %s",
@@ -142,11 +504,24 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
             info,
         )
         video_path = next(result["path"] for ok, result in results if ok)
+        if self._flat_output and self._flat_output_links:
+            link_path = self._output_dir / _readable_path(item)
+            utils.atomic_symlink(self._output_dir / video_path, link_path)
+            self.logger.debug("Linked %s to %s", link_path, video_path)
         return dc.replace(item, download_path=video_path)
 
     def close_spider(self, spider: spiders.ExpertCoursesSpider):
         self.logger.debug("Closing %s spider", spider.name)
 
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler):
+        pipeline = super().from_crawler(crawler)
+        crawler.signals.connect(
+            pipeline._headers_received,
+            signal=scrapy.signals.headers_received,
+        )
+        return pipeline
+
     @classmethod
     def from_settings(cls, settings: scrapy.settings.Settings):
         logger = logging.getLogger(f"{__name__}.{cls.__name__}")
@@ -154,9 +529,131 @@ class LessonVideosPipeline(scrapy.pipelines.files.FilesPipeline):
         return cls(
             output_dir=_get_output_dir(settings),
             flat_output=_get_flat_output(settings),
+            flat_output_links=_get_flat_output_links(settings),
+            min_free_space=_get_min_free_space(settings),
+            download_order=_get_download_order(settings),
+            max_active_downloads=_get_max_active_downloads(settings),
         )
 
 
+class VideoValidationPipeline:
+    """Check downloaded videos' MP4 structure in a process pool.
+
+    Invalid videos are deleted and dropped, along with any flat output link
+    to them, so they free their space and the next run downloads them again.
+    """
+
+    _executor: Optional[concurrent.futures.ProcessPoolExecutor]
+    _flat_output: bool
+    _flat_output_links: bool
+    _max_workers: Optional[int]
+    _output_dir: pathlib.Path
+
+    def __init__(
+        self,
+        output_dir: Union[str, pathlib.Path],
+        max_workers: Optional[int] = None,
+        flat_output: bool = False,
+        flat_output_links: bool = True,
+    ):
+        self._output_dir = pathlib.Path(output_dir).resolve()
+        self._max_workers = max_workers
+        self._flat_output = flat_output
+        self._flat_output_links = flat_output_links
+        self._executor = None
+
+    @fn.cached_property
+    def logger(self):
+        return logging.getLogger(f"{__name__}.{self.__class__.__name__}")
+
+    def open_spider(self, spider: spiders.ExpertCoursesSpider):
+        self.logger.debug("Opening %s spider", spider.name)
+        # Workers start lazily from a multi-threaded process, so don't fork.
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    def process_item(
+        self,
+        item: items.Video,
+        spider: spiders.ExpertCoursesSpider,
+    ):
+        self.logger.debug(
+            "Processing %s spider item: %s",
+            spider.name,
+            item,
+        )
+        from twisted.internet import reactor
+
+        assert self._executor is not None, "spider must be opened"
+        video_path = self._output_dir / item.download_path
+        future = self._executor.submit(mp4.validate, video_path)
+        validated = defer.Deferred()
+        future.add_done_callback(
+            lambda future: reactor.callFromThread(
+                self._future_done, future, validated
+            )
+        )
+        validated.addCallback(
+            lambda duration: dc.replace(item, duration=duration)
+        )
+        validated.addErrback(self._invalid_video, item, video_path)
+        return validated
+
+    @staticmethod
+    def _future_done(
+        future: concurrent.futures.Future,
+        validated: defer.Deferred,
+    ):
+        if future.cancelled():
+            validated.errback(
+                scrapy.exceptions.DropItem("Video validation was cancelled")
+            )
+            return
+        exception = future.exception()
+        if exception is None:
+            validated.callback(future.result())
+        else:
+            validated.errback(exception)
+
+    def _invalid_video(self, failure, item: items.Video, path: pathlib.Path):
+        failure.trap(mp4.InvalidMP4Error)
+        self.logger.error(
+            "Invalid video %s, deleting it for re-download: %s",
+            path,
+            failure.value,
+        )
+        with contextlib.suppress(FileNotFoundError):
+            path.unlink()
+        if self._flat_output and self._flat_output_links:
+            link_path = self._output_dir / _readable_path(item)
+            with contextlib.suppress(FileNotFoundError):
+                link_path.unlink()
+        raise scrapy.exceptions.DropItem(f"Invalid video {item}")
+
+    def close_spider(self, spider: spiders.ExpertCoursesSpider):
+        self.logger.debug("Closing %s spider", spider.name)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    @classmethod
+    def from_settings(cls, settings: scrapy.settings.Settings):
+        return cls(
+            output_dir=_get_output_dir(settings),
+            max_workers=_get_validation_processes(settings),
+            flat_output=_get_flat_output(settings),
+            flat_output_links=_get_flat_output_links(settings),
+        )
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
 class ExpertIndexItem(NamedTuple):
     expert: items.Expert
     course: items.Course
@@ -223,7 +720,7 @@ class CourseIndexPipeline:
         self.logger.debug("Closing %s spider", spider.name)
 
         self._expert_index.sort()
-        with self._index_path.open("wt") as md:
+        with utils.atomic_open(self._index_path, "wt") as md:
             md.write("# Grapplers Guide\n")
             md.write("\n")
             for expert, course_index in it.groupby(
@@ -243,7 +740,7 @@ class CourseIndexPipeline:
                     ):
                         md.write(f"#### {section.title}\n")
                         md.write("\n")
-                        for lesson, video in it.groupby(
+                        for lesson, video_index in it.groupby(
                             lesson_index, key=op.attrgetter("lesson")
                         ):
                             breadcrumbs = " -> ".join(lesson.breadcrumbs)
@@ -252,6 +749,13 @@ class CourseIndexPipeline:
                             md.write("\n")
                             md.write(f"- Breadcrumbs: {breadcrumbs}\n")
                             md.write(f"- Tags: {tags}\n")
+                            for index_item in video_index:
+                                duration = index_item.video.duration
+                                if duration is not None:
+                                    md.write(
+                                        "- Duration:"
+                                        f" {_format_duration(duration)}\n"
+                                    )
                             md.write("\n")
 
     @classmethod
@@ -70,10 +70,34 @@ LESSONVIDEOSPIPELINE_MEDIA_ALLOW_REDIRECTS = True
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     "grapplersguide.pipelines.LessonVideosPipeline": 1,
+    "grapplersguide.pipelines.VideoValidationPipeline": 10,
     "grapplersguide.pipelines.CourseIndexPipeline": 20,
 }
 FILES_STORE = tempfile.mkdtemp()
 
+# With FLAT_OUTPUT, videos are stored under hash-sharded ab/cd/ directories
+# and FLAT_OUTPUT_LINKS adds symlinks at the readable Expert/Course/Section
+# paths (default: FLAT_OUTPUT off, FLAT_OUTPUT_LINKS on)
+# FLAT_OUTPUT = False
+# FLAT_OUTPUT_LINKS = True
+
+# Where lesson URL to download data URL mappings are kept between runs, so
+# reruns skip each lesson's intermediate download page
+# (default: OUTPUT_DIR/.download-data-urls.json)
+# DOWNLOAD_DATA_URLS_PATH = ".download-data-urls.json"
+
+# Video downloads are held until they fit on disk while keeping this much
+# space free, as bytes or a size like "5GB" (default: 1GB). Videos that do
+# not fit once nothing else is downloading are dropped for a later run.
+# MIN_FREE_SPACE = "1GB"
+# Order held videos start in, "course" or "smallest" (default: course)
+# DOWNLOAD_ORDER = "course"
+# Maximum videos downloading at once, 0 for no limit (default: 0)
+# MAX_ACTIVE_DOWNLOADS = 0
+
+# Processes checking downloaded MP4 files, 0 for one per CPU (default: 0)
+# VALIDATION_PROCESSES = 0
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -1,12 +1,67 @@
 import dataclasses as dc
+import json
 import operator as op
+import pathlib
 import re
 import urllib.parse
-from typing import Union
+from typing import Dict, Optional, Union
 
 import scrapy
 
-from . import items
+from . import items, utils
+
+
+def _get_download_data_url(url: str) -> Optional[str]:
+    """Build the ``load_download_data`` URL from a video download page URL.
+
+    Returns ``None`` when the URL does not have the expected
+    ``/<user_id>/download/<some_other_id>/<video_id>`` shape.
+    """
+    split_url = urllib.parse.urlsplit(url)
+    parts = split_url.path.split("/")
+    if len(parts) != 5 or parts[0] or not all(parts[1:]):
+        return None
+    _, user_id, resource, some_other_id, video_id = parts
+    if resource != "download":
+        return None
+    path = f"/{user_id}/{resource}/data/{some_other_id}/{video_id}"
+    query_string = urllib.parse.urlencode({"action": "load_download_data"})
+    return urllib.parse.urlunsplit(
+        (split_url.scheme, split_url.netloc, path, query_string, "")
+    )
+
+
+def _get_download_data_urls_path(settings) -> pathlib.Path:
+    output_dir = pathlib.Path(settings.get("OUTPUT_DIR", pathlib.Path.cwd()))
+    return pathlib.Path(
+        settings.get(
+            "DOWNLOAD_DATA_URLS_PATH",
+            output_dir / ".download-data-urls.json",
+        )
+    )
+
+
+def _load_download_data_urls(path: pathlib.Path) -> Dict[str, str]:
+    """Load cached download data URLs.
+
+    Raises ValueError when the file is not a JSON object of URLs.
+    """
+    try:
+        with path.open("rt") as f:
+            urls = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if not isinstance(urls, dict) or not all(
+        isinstance(url, str) for url in urls.values()
+    ):
+        raise ValueError(f"Expected a JSON object of URLs in {path}")
+    return urls
+
+
+def _save_download_data_urls(path: pathlib.Path, urls: Dict[str, str]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with utils.atomic_open(path, "wt") as f:
+        json.dump(urls, f, indent=2, sort_keys=True)
 
 
 class ExpertCoursesSpider(scrapy.Spider):
@@ -21,6 +76,8 @@ class ExpertCoursesSpider(scrapy.Spider):
         "https://grapplersguide.com/second-portal/login",
     ]
     _course_regex: re.Pattern
+    _download_data_urls: Dict[str, str]
+    _download_data_urls_path: Optional[pathlib.Path]
     _expert_regex: re.Pattern
 
     def __init__(
@@ -34,10 +91,31 @@ class ExpertCoursesSpider(scrapy.Spider):
         self._password = password
         self._expert_regex = re.compile(expert_regex, flags=re.IGNORECASE)
         self._course_regex = re.compile(course_regex, flags=re.IGNORECASE)
+        self._download_data_urls = {}
+        self._download_data_urls_path = None
         super().__init__()
 
     def start_requests(self):
         self.logger.debug("Starting requests...")
+        self._download_data_urls_path = _get_download_data_urls_path(
+            self.settings
+        )
+        try:
+            self._download_data_urls = _load_download_data_urls(
+                self._download_data_urls_path
+            )
+        except ValueError as error:
+            self.logger.warning(
+                "Ignoring unreadable download data URLs in %s: %s",
+                self._download_data_urls_path,
+                error,
+            )
+            self._download_data_urls = {}
+        self.logger.debug(
+            "Loaded %d cached download data URLs from %s",
+            len(self._download_data_urls),
+            self._download_data_urls_path,
+        )
         for url in self.login_urls:
             yield scrapy.Request(url=url, callback=self.parse_login)
 
@@ -135,40 +213,107 @@ class ExpertCoursesSpider(scrapy.Spider):
         download_link = response.xpath(
             "//li[@id='lesson-actions']//a[contains(@href, '/download')]"
         )
-        download_path = download_link.attrib["href"]
-        yield scrapy.Request(
-            url=response.urljoin(download_path),
+        download_url = response.urljoin(download_link.attrib["href"])
+        lesson = dc.replace(lesson, breadcrumbs=breadcrumbs, tags=tags)
+
+        # Skip the intermediate download page when a previous run already
+        # resolved it, or when the link already points at the video's
+        # download resource.
+        download_data_url = self._download_data_urls.get(lesson.url)
+        if download_data_url is not None:
+            self.logger.debug(
+                "Cached download data URL for %s: %s",
+                lesson,
+                download_data_url,
+            )
+            yield self._download_data_request(
+                download_data_url,
+                lesson,
+                download_url=download_url,
+            )
+            return
+        download_data_url = _get_download_data_url(download_url)
+        if download_data_url is not None:
+            self.logger.debug(
+                "Derived download data URL for %s: %s",
+                lesson,
+                download_data_url,
+            )
+            self._download_data_urls[lesson.url] = download_data_url
+            yield self._download_data_request(
+                download_data_url,
+                lesson,
+                download_url=download_url,
+            )
+            return
+
+        yield self._download_page_request(download_url, lesson)
+
+    def _download_page_request(self, url: str, lesson: items.Lesson):
+        return scrapy.Request(
+            url=url,
             callback=self.parse_download_page,
-            cb_kwargs={
-                "lesson": dc.replace(
-                    lesson,
-                    breadcrumbs=breadcrumbs,
-                    tags=tags,
-                ),
-            },
+            cb_kwargs={"lesson": lesson},
         )
 
     def parse_download_page(self, response, lesson: items.Lesson):
         assert lesson.breadcrumbs is not None, "breadcrumbs must be a tuple"
         assert lesson.tags is not None, "tags must be a frozenset"
         self.logger.debug("Parsing download page: %s", lesson)
-        url = urllib.parse.urlsplit(response.url)
-        _, user_id, resource, some_other_id, video_id = url.path.split("/")
-        assert resource == "download", f"Want `download`, got `{resource}`"
-        path = f"/{user_id}/{resource}/data/{some_other_id}/{video_id}"
-        query_string = urllib.parse.urlencode({"action": "load_download_data"})
+        download_data_url = _get_download_data_url(response.url)
+        assert (
+            download_data_url is not None
+        ), f"Unexpected download page URL: {response.url}"
+        self._download_data_urls[lesson.url] = download_data_url
+        yield self._download_data_request(download_data_url, lesson)
+
+    def _download_data_request(
+        self,
+        url: str,
+        lesson: items.Lesson,
+        download_url: Optional[str] = None,
+    ):
+        """Request download data, falling back to ``download_url`` if given."""
         headers = {"x-requested-with": "XMLHttpRequest"}
-        yield scrapy.Request(
-            url=response.urljoin(f"{path}?{query_string}"),
+        return scrapy.Request(
+            url=url,
             headers=headers,
             callback=self.parse_download_data,
+            errback=(
+                None if download_url is None else self.download_data_failed
+            ),
             cb_kwargs={"lesson": lesson},
+            meta={"download_url": download_url},
+        )
+
+    def download_data_failed(self, failure):
+        request = failure.request
+        lesson = request.cb_kwargs["lesson"]
+        self.logger.warning(
+            "Download data URL failed for %s, refetching: %s",
+            lesson,
+            failure.value,
         )
+        self._download_data_urls.pop(lesson.url, None)
+        yield self._download_page_request(request.meta["download_url"], lesson)
 
     def parse_download_data(self, response, lesson: items.Lesson):
         self.logger.debug("Parsing download data: %s", lesson)
-        data = response.json()
-        files = data["download_config"]["files"]
+        try:
+            files = response.json()["download_config"]["files"]
+        except (ValueError, KeyError, TypeError) as error:
+            # Don't keep a URL that serves something else, like a login page
+            self._download_data_urls.pop(lesson.url, None)
+            download_url = response.meta.get("download_url")
+            if download_url is None:
+                raise
+            self.logger.warning(
+                "Unexpected download data for %s, refetching: %r",
+                lesson,
+                error,
+            )
+            yield self._download_page_request(download_url, lesson)
+            return
         highest_quality_file = max(files, key=op.itemgetter("height"))
         video_fields = {field.name for field in dc.fields(items.Video)}
         yield items.Video(
@@ -179,3 +324,16 @@ class ExpertCoursesSpider(scrapy.Spider):
                 if key in video_fields
             },
         )
+
+    def closed(self, reason: str):
+        if self._download_data_urls_path is None:
+            return
+        self.logger.debug(
+            "Saving %d download data URLs to %s",
+            len(self._download_data_urls),
+            self._download_data_urls_path,
+        )
+        _save_download_data_urls(
+            self._download_data_urls_path,
+            self._download_data_urls,
+        )
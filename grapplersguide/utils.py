@@ -0,0 +1,38 @@
+# Filesystem helpers shared by the spiders and pipelines.
+import contextlib
+import os
+import os.path
+import pathlib
+from typing import IO, Iterator
+
+
+@contextlib.contextmanager
+def atomic_open(path: pathlib.Path, mode: str = "wb") -> Iterator[IO]:
+    """Open a temporary file next to ``path`` and rename it over on success.
+
+    Readers and reruns only ever see ``path`` missing or complete. The
+    temporary name is fixed per ``path``, so one left behind by a killed run
+    is overwritten when the file is next written.
+    """
+    temp_path = path.with_name(f".{path.name}.part")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            temp_path.unlink()
+        raise
+
+
+def atomic_symlink(target: pathlib.Path, link: pathlib.Path):
+    """Point ``link`` at ``target`` with a relative symlink, replacing it."""
+    link.parent.mkdir(parents=True, exist_ok=True)
+    temp_link = link.with_name(f".{link.name}.link")
+    with contextlib.suppress(FileNotFoundError):
+        temp_link.unlink()
+    temp_link.symlink_to(os.path.relpath(target, link.parent))
+    os.replace(temp_link, link)
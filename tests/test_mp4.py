@@ -0,0 +1,58 @@
+import struct
+
+import pytest
+
+from grapplersguide import mp4
+
+
+def _box(box_type: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _mvhd(timescale: int, duration: int, version: int = 0) -> bytes:
+    if version == 1:
+        fields = struct.pack(">QQIQ", 0, 0, timescale, duration)
+    else:
+        fields = struct.pack(">IIII", 0, 0, timescale, duration)
+    return _box(b"mvhd", bytes([version, 0, 0, 0]) + fields + bytes(80))
+
+
+FTYP = _box(b"ftyp", b"isom\0\0\0\0")
+MDAT = _box(b"mdat", bytes(100))
+
+
+def _write(tmp_path, data: bytes):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    return path
+
+
+def test_validate(tmp_path):
+    path = _write(tmp_path, FTYP + _box(b"moov", _mvhd(1000, 65500)) + MDAT)
+    assert mp4.validate(path) == 65.5
+
+
+def test_validate_version_1_mvhd(tmp_path):
+    moov = _box(b"moov", _mvhd(600, 600 * 3600, version=1))
+    path = _write(tmp_path, FTYP + moov + MDAT)
+    assert mp4.validate(path) == 3600
+
+
+def test_validate_truncated_mdat(tmp_path):
+    data = FTYP + _box(b"moov", _mvhd(1000, 65500)) + MDAT
+    path = _write(tmp_path, data[:-10])
+    with pytest.raises(mp4.InvalidMP4Error, match="mdat"):
+        mp4.validate(path)
+
+
+def test_validate_truncated_trailing_moov(tmp_path):
+    data = FTYP + MDAT + _box(b"moov", _mvhd(1000, 65500))
+    path = _write(tmp_path, data[:-40])
+    with pytest.raises(mp4.InvalidMP4Error, match="moov"):
+        mp4.validate(path)
+
+
+def test_validate_missing_mvhd(tmp_path):
+    path = _write(tmp_path, FTYP + _box(b"moov", _box(b"trak")) + MDAT)
+    with pytest.raises(mp4.InvalidMP4Error, match="mvhd"):
+        mp4.validate(path)
@@ -0,0 +1,403 @@
+import concurrent.futures
+import dataclasses as dc
+import hashlib
+import queue
+import struct
+from typing import Optional
+
+import pytest
+import scrapy.pipelines.files
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from grapplersguide import items, pipelines, utils
+
+
+def _video(
+    title: str,
+    size: str,
+    download_url: Optional[str] = None,
+) -> items.Video:
+    expert = items.Expert(name="Expert")
+    course = items.Course(title="Course", expert=expert)
+    section = items.Section(position=1, title="Section", course=course)
+    lesson = items.Lesson(
+        position=1,
+        title=title,
+        url=f"https://grapplersguide.com/{title}",
+        section=section,
+    )
+    return items.Video(
+        file_name=f"{title}.mp4",
+        public_name="HD",
+        base_file_name=title,
+        extension="mp4",
+        download_name=f"{title}.mp4",
+        size=size,
+        height=720,
+        width=1280,
+        video_file_id=title,
+        download_url=download_url or f"https://vimeo.com/{title}",
+        lesson=lesson,
+    )
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [
+        (None, None),
+        (123, 123),
+        ("123", 123),
+        ("10B", 10),
+        ("2kb", 2048),
+        ("117.7MB", 123417395),
+        ("1.5 GiB", 1610612736),
+        ("bogus", None),
+    ],
+)
+def test_parse_size(size, expected):
+    assert pipelines._parse_size(size) == expected
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    started = {}
+
+    def process_item(self, item, spider):
+        started[item.lesson.title] = defer.Deferred()
+        return started[item.lesson.title]
+
+    monkeypatch.setattr(
+        scrapy.pipelines.files.FilesPipeline, "process_item", process_item
+    )
+    return started
+
+
+def _pipeline(tmp_path, monkeypatch, free_space: int, **settings):
+    crawler = get_crawler(
+        settings_dict={"OUTPUT_DIR": str(tmp_path), **settings}
+    )
+    pipeline = pipelines.LessonVideosPipeline.from_crawler(crawler)
+    monkeypatch.setattr(pipeline, "_free_space", lambda: free_space)
+    return pipeline
+
+
+def test_holds_downloads_in_smallest_order(tmp_path, monkeypatch, downloads):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=1 << 30,
+        MIN_FREE_SPACE=0,
+        DOWNLOAD_ORDER="smallest",
+        MAX_ACTIVE_DOWNLOADS=1,
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    results = [
+        pipeline.process_item(_video(title, size), spider)
+        for title, size in [("a", "3MB"), ("b", "1MB"), ("c", "2MB")]
+    ]
+    assert list(downloads) == ["a"]
+    assert pipeline._reserved_space == 3 << 20
+
+    downloads["a"].callback("a")
+    assert list(downloads) == ["a", "b"]
+    downloads["b"].callback("b")
+    assert list(downloads) == ["a", "b", "c"]
+    downloads["c"].callback("c")
+
+    assert [result.result for result in results] == ["a", "b", "c"]
+    assert pipeline._reserved_space == 0
+    assert pipeline._active_downloads == 0
+
+
+def test_holds_downloads_until_space_is_free(tmp_path, monkeypatch, downloads):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=5 << 20,
+        MIN_FREE_SPACE="2MB",
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    pipeline.process_item(_video("a", "2MB"), spider)
+    pipeline.process_item(_video("b", "2MB"), spider)
+    assert list(downloads) == ["a"]
+
+    downloads["a"].callback("a")
+    assert list(downloads) == ["a", "b"]
+    downloads["b"].callback("b")
+    assert pipeline._reserved_space == 0
+
+
+def test_drops_downloads_that_never_fit(tmp_path, monkeypatch, downloads):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=3 << 20,
+        MIN_FREE_SPACE=0,
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    too_big = pipeline.process_item(_video("a", "4MB"), spider)
+    fits = pipeline.process_item(_video("b", "2MB"), spider)
+    assert list(downloads) == ["b"]
+    with pytest.raises(scrapy.exceptions.DropItem):
+        too_big.result.raiseException()
+    too_big.addErrback(lambda _: None)
+
+    downloads["b"].callback("b")
+    assert fits.result == "b"
+    assert pipeline._reserved_space == 0
+
+
+def test_drops_held_downloads_when_closing(tmp_path, monkeypatch, downloads):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=3 << 20,
+        MIN_FREE_SPACE=0,
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    pipeline.process_item(_video("a", "2MB"), spider)
+    held = pipeline.process_item(_video("b", "2MB"), spider)
+    assert list(downloads) == ["a"]
+
+    class Engine:
+        running = False
+        slot = None
+
+    pipeline.crawler.engine = Engine()
+    downloads["a"].callback("a")
+    assert list(downloads) == ["a"]
+    with pytest.raises(scrapy.exceptions.DropItem):
+        held.result.raiseException()
+    held.addErrback(lambda _: None)
+
+
+def test_reserves_nothing_for_downloaded_videos(
+    tmp_path, monkeypatch, downloads
+):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=0,
+        MIN_FREE_SPACE="1GB",
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    video = _video("a", "2MB")
+    video_path = tmp_path / pipeline.file_path(None, item=video)
+    video_path.parent.mkdir(parents=True)
+    video_path.write_bytes(b"video")
+
+    result = pipeline.process_item(video, spider)
+    assert list(downloads) == ["a"]
+    assert pipeline._reserved_space == 0
+    downloads["a"].callback("a")
+    assert result.result == "a"
+
+
+def test_reserves_downloads_with_the_same_url(tmp_path, monkeypatch, downloads):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=1 << 30,
+        MIN_FREE_SPACE=0,
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    url = "https://vimeo.com/same"
+    pipeline.process_item(_video("a", "1MB", download_url=url), spider)
+    pipeline.process_item(_video("b", "2MB", download_url=url), spider)
+    assert pipeline._reserved_space == 3 << 20
+
+    downloads["a"].callback("a")
+    assert pipeline._reserved_space == 2 << 20
+    downloads["b"].callback("b")
+    assert pipeline._reserved_space == 0
+
+
+def test_requeues_redirected_downloads_larger_than_reserved(
+    tmp_path, monkeypatch
+):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=3 << 20,
+        MIN_FREE_SPACE=0,
+    )
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    attempts = []
+
+    def process_item(self, item, spider):
+        request = next(self.get_media_requests(item, None))
+        downloaded = defer.Deferred()
+        attempts.append((item, request, downloaded, self._reserved_space))
+        return downloaded
+
+    monkeypatch.setattr(
+        scrapy.pipelines.files.FilesPipeline, "process_item", process_item
+    )
+    pipeline.process_item(_video("other", "1MB"), spider)
+    video = _video("a", "1MB")
+    result = pipeline.process_item(video, spider)
+    _, _, other_downloaded, _ = attempts[0]
+    _, request, downloaded, reserved_space = attempts[1]
+    assert reserved_space == 2 << 20
+
+    redirected = request.replace(url="https://cdn.vimeo.com/a.mp4")
+    assert redirected.meta is not request.meta
+    pipeline._headers_received({}, "UNKNOWN_LENGTH", redirected, spider)
+    pipeline._headers_received({}, 2 << 20, redirected, spider)
+    assert pipeline._reserved_space == 3 << 20
+    with pytest.raises(scrapy.exceptions.StopDownload):
+        pipeline._headers_received({}, 4 << 20, redirected, spider)
+    try:
+        pipeline.media_failed(
+            Failure(scrapy.exceptions.StopDownload(fail=True)), request, None
+        )
+    except pipelines._InsufficientSpace:
+        downloaded.errback()
+    assert len(attempts) == 2
+    assert pipeline._reserved_space == 1 << 20
+
+    pipeline._free_space = lambda: 5 << 20
+    other_downloaded.callback("other")
+    _, _, downloaded, reserved_space = attempts[2]
+    assert reserved_space == 4 << 20
+    downloaded.callback(video)
+    assert result.result is video
+    assert pipeline._reserved_space == 0
+
+
+def test_sharded_file_path(tmp_path, monkeypatch):
+    pipeline = _pipeline(
+        tmp_path, monkeypatch, free_space=1 << 30, FLAT_OUTPUT=True
+    )
+    video = _video("a", "1MB")
+    digest = hashlib.sha1(b"a").hexdigest()
+    assert pipeline.file_path(None, item=video) == (
+        f"{digest[:2]}/{digest[2:4]}/{digest}.mp4"
+    )
+
+
+def test_readable_file_path(tmp_path, monkeypatch):
+    pipeline = _pipeline(tmp_path, monkeypatch, free_space=1 << 30)
+    video = _video("a", "1MB")
+    assert pipeline.file_path(None, item=video) == (
+        "Expert/Course/01 - Section/01 - a (HD).mp4"
+    )
+
+
+@pytest.mark.parametrize("flat_output_links", [True, False])
+def test_item_completed_links_flat_output(
+    tmp_path, monkeypatch, flat_output_links
+):
+    pipeline = _pipeline(
+        tmp_path,
+        monkeypatch,
+        free_space=1 << 30,
+        FLAT_OUTPUT=True,
+        FLAT_OUTPUT_LINKS=flat_output_links,
+    )
+    video = _video("a", "1MB")
+    video_path = pipeline.file_path(None, item=video)
+    (tmp_path / video_path).parent.mkdir(parents=True)
+    (tmp_path / video_path).write_bytes(b"video")
+
+    completed = pipeline.item_completed(
+        [(True, {"path": video_path})], video, None
+    )
+    assert completed.download_path == video_path
+    link_path = tmp_path / pipelines._readable_path(video)
+    if flat_output_links:
+        assert link_path.is_symlink()
+        assert link_path.resolve() == (tmp_path / video_path).resolve()
+    else:
+        assert not link_path.exists()
+        assert not link_path.parent.exists()
+
+
+def test_invalid_video_removes_flat_output_link(tmp_path):
+    pipeline = pipelines.VideoValidationPipeline(
+        tmp_path, flat_output=True, flat_output_links=True
+    )
+    video = _video("a", "1MB")
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"garbled")
+    link_path = tmp_path / pipelines._readable_path(video)
+    utils.atomic_symlink(video_path, link_path)
+
+    with pytest.raises(scrapy.exceptions.DropItem):
+        pipeline._invalid_video(
+            Failure(pipelines.mp4.InvalidMP4Error("garbled")),
+            video,
+            video_path,
+        )
+    assert list(tmp_path.rglob("*.mp4*")) == []
+    assert not link_path.is_symlink()
+
+
+def _mp4(duration: int) -> bytes:
+    def box(box_type: bytes, payload: bytes = b"") -> bytes:
+        return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+    mvhd = box(b"mvhd", bytes(4) + struct.pack(">IIII", 0, 0, 1, duration))
+    return box(b"ftyp", b"isom") + box(b"moov", mvhd) + box(b"mdat", bytes(8))
+
+
+def test_validates_videos_in_process_pool(tmp_path, monkeypatch):
+    import twisted.internet.reactor
+
+    from_thread = queue.Queue()
+    monkeypatch.setattr(
+        twisted.internet.reactor,
+        "callFromThread",
+        lambda f, *args: from_thread.put((f, args)),
+    )
+    good = dc.replace(_video("good", "1MB"), download_path="good.mp4")
+    bad = dc.replace(_video("bad", "1MB"), download_path="bad.mp4")
+    (tmp_path / "good.mp4").write_bytes(_mp4(65))
+    (tmp_path / "bad.mp4").write_bytes(_mp4(65)[:-4])
+    pipeline = pipelines.VideoValidationPipeline(tmp_path, max_workers=1)
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    pipeline.open_spider(spider)
+    try:
+        validated = [
+            pipeline.process_item(good, spider),
+            pipeline.process_item(bad, spider),
+        ]
+        for _ in validated:
+            f, args = from_thread.get(timeout=30)
+            f(*args)
+    finally:
+        pipeline.close_spider(spider)
+
+    assert validated[0].result == dc.replace(good, duration=65)
+    with pytest.raises(scrapy.exceptions.DropItem):
+        validated[1].result.raiseException()
+    validated[1].addErrback(lambda _: None)
+    assert not (tmp_path / "bad.mp4").exists()
+
+
+def test_cancelled_validation_drops_item():
+    future = concurrent.futures.Future()
+    future.cancel()
+    validated = defer.Deferred()
+    pipelines.VideoValidationPipeline._future_done(future, validated)
+    with pytest.raises(scrapy.exceptions.DropItem):
+        validated.result.raiseException()
+    validated.addErrback(lambda _: None)
+
+
+def test_index_includes_durations(tmp_path):
+    pipeline = pipelines.CourseIndexPipeline(tmp_path)
+    spider = object.__new__(pipelines.spiders.ExpertCoursesSpider)
+    spider.name = "expert-courses"
+    pipeline.open_spider(spider)
+    video = _video("a", "1MB")
+    video = dc.replace(
+        video,
+        lesson=dc.replace(video.lesson, breadcrumbs=("Course",), tags=()),
+        duration=3725.4,
+    )
+    pipeline.process_item(video, spider)
+    pipeline.close_spider(spider)
+    assert "- Duration: 1:02:05\n" in (tmp_path / "index.md").read_text()
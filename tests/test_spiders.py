@@ -0,0 +1,118 @@
+import pytest
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from grapplersguide import items, spiders
+
+
+def test_get_download_data_url():
+    assert spiders._get_download_data_url(
+        "https://vimeo.com/12345/download/67890/abcdef"
+    ) == (
+        "https://vimeo.com/12345/download/data/67890/abcdef"
+        "?action=load_download_data"
+    )
+
+
+def test_get_download_data_url_unexpected_shape():
+    assert (
+        spiders._get_download_data_url(
+            "https://grapplersguide.com/second-portal/lessons/1/download"
+        )
+        is None
+    )
+    assert (
+        spiders._get_download_data_url(
+            "https://vimeo.com/12345/download/67890/abcdef/"
+        )
+        is None
+    )
+    assert (
+        spiders._get_download_data_url(
+            "https://vimeo.com/12345/video/67890/abcdef"
+        )
+        is None
+    )
+
+
+def test_download_data_urls_round_trip(tmp_path):
+    path = tmp_path / "cache" / "download-data-urls.json"
+    assert spiders._load_download_data_urls(path) == {}
+    urls = {"https://grapplersguide.com/lesson/1": "https://vimeo.com/data"}
+    spiders._save_download_data_urls(path, urls)
+    assert spiders._load_download_data_urls(path) == urls
+    assert list(path.parent.iterdir()) == [path]
+
+
+def _spider(tmp_path):
+    crawler = get_crawler(settings_dict={"OUTPUT_DIR": str(tmp_path)})
+    return spiders.ExpertCoursesSpider.from_crawler(
+        crawler,
+        username="",
+        password="",
+        expert_regex=".+",
+        course_regex=".+",
+    )
+
+
+def _lesson() -> items.Lesson:
+    expert = items.Expert(name="Expert")
+    course = items.Course(title="Course", expert=expert)
+    section = items.Section(position=1, title="Section", course=course)
+    return items.Lesson(
+        position=1,
+        title="Lesson",
+        url="https://grapplersguide.com/lessons/1",
+        section=section,
+        breadcrumbs=(),
+        tags=frozenset(),
+    )
+
+
+def test_start_requests_ignores_corrupt_cache(tmp_path):
+    (tmp_path / ".download-data-urls.json").write_text("{not json")
+    spider = _spider(tmp_path)
+    assert list(spider.start_requests())
+    assert spider._download_data_urls == {}
+
+
+def test_load_download_data_urls_rejects_non_objects(tmp_path):
+    path = tmp_path / "download-data-urls.json"
+    path.write_text("[]")
+    with pytest.raises(ValueError):
+        spiders._load_download_data_urls(path)
+
+
+def test_parse_lesson_falls_back_from_derived_url(tmp_path):
+    spider = _spider(tmp_path)
+    list(spider.start_requests())
+    lesson = _lesson()
+    response = HtmlResponse(
+        url=lesson.url,
+        body=b"<li id='lesson-actions'>"
+        b"<a href='https://vimeo.com/1/download/2/3'>Download</a></li>",
+    )
+    (request,) = spider.parse_lesson(response, lesson)
+    assert request.callback == spider.parse_download_data
+    assert request.errback == spider.download_data_failed
+    assert request.meta["download_url"] == "https://vimeo.com/1/download/2/3"
+
+
+def test_parse_download_data_drops_unexpected_responses(tmp_path):
+    spider = _spider(tmp_path)
+    list(spider.start_requests())
+    lesson = _lesson()
+    data_url = "https://vimeo.com/1/download/data/2/3"
+    spider._download_data_urls[lesson.url] = data_url
+    request = spider._download_data_request(
+        data_url,
+        lesson,
+        download_url="https://grapplersguide.com/lessons/1/download",
+    )
+    response = HtmlResponse(
+        url=data_url, body=b"<form>Log in</form>", request=request
+    )
+    (fallback,) = spider.parse_download_data(response, lesson)
+    assert fallback.url == "https://grapplersguide.com/lessons/1/download"
+    assert fallback.callback == spider.parse_download_page
+    assert lesson.url not in spider._download_data_urls
@@ -0,0 +1,41 @@
+import pytest
+
+from grapplersguide import utils
+
+
+def test_atomic_open(tmp_path):
+    path = tmp_path / "index.md"
+    with utils.atomic_open(path, "wt") as f:
+        f.write("complete")
+    with pytest.raises(RuntimeError):
+        with utils.atomic_open(path, "wt") as f:
+            f.write("partial")
+            raise RuntimeError
+    assert path.read_text() == "complete"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_atomic_open_overwrites_partial_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    (tmp_path / ".video.mp4.part").write_bytes(b"partial from a killed run")
+    with utils.atomic_open(path) as f:
+        f.write(b"video")
+    assert path.read_bytes() == b"video"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_atomic_symlink_replaces_link(tmp_path):
+    first = tmp_path / "ab" / "first.mp4"
+    second = tmp_path / "ab" / "second.mp4"
+    first.parent.mkdir()
+    first.write_bytes(b"first")
+    second.write_bytes(b"second")
+    link = tmp_path / "Expert" / "video.mp4"
+    (tmp_path / "Expert").mkdir()
+    (tmp_path / "Expert" / ".video.mp4.link").write_bytes(b"stale")
+
+    utils.atomic_symlink(first, link)
+    utils.atomic_symlink(second, link)
+    assert link.read_bytes() == b"second"
+    assert not link.readlink().is_absolute()
+    assert list(link.parent.iterdir()) == [link]